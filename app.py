@@ -1,10 +1,17 @@
 # app.py
 import streamlit as st
 import pandas as pd
-import re
+import io
+import logging
+import tiktoken
 from datetime import datetime
-from comment_fetcher import get_all_comments
+from functools import lru_cache
+from typing import Callable, Iterator
+from comment_fetcher import get_all_comments, extract_single_video_id
 from google import genai
+import semantic_cache
+
+logger = logging.getLogger(__name__)
 
 # -----------------------------
 # 🤖 Gemini Client
@@ -12,63 +19,134 @@ from google import genai
 
 YOUTUBE_API_KEY = st.secrets["YOUTUBE_API_KEY"]
 GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
-client = genai.Client(api_key=GEMINI_API_KEY)
+
+
+@st.cache_resource
+def get_client():
+    # สร้าง client ครั้งเดียว (object เดิมทุก rerun เพื่อให้ cache ของ embedding ใช้ได้)
+    return genai.Client(api_key=GEMINI_API_KEY)
+
+
+client = get_client()
+
+
+@st.cache_resource
+def get_semantic_cache():
+    # เปิด connection ครั้งเดียว ใช้ร่วมกันทุก rerun / ทุก session
+    return semantic_cache.connect()
 
 # -----------------------------
 # 🧩 Helper Functions
 # -----------------------------
-VIDEO_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+FETCH_CACHE_TTL = 3600  # ดึงวิดีโอเดิมซ้ำภายใน 1 ชม. ใช้ผลเดิม ไม่เสีย quota
+PROMPT_MAX_TOKENS = 250_000
+# เผื่อ ~4 ตัวอักษรต่อ token (ภาษาอังกฤษ) ตอนดึงคอมเมนต์ ภาษาไทยจะได้ token ต่อตัวอักษรมากกว่านี้จึงยังพอ
+FETCH_CHAR_BUDGET = PROMPT_MAX_TOKENS * 4
+# คอลัมน์ที่แสดงบนหน้าเว็บ (ไฟล์ CSV ยังมีครบทุกคอลัมน์)
+PREVIEW_COLUMNS = ("comment", "author", "like_count", "published_at")
+PREVIEW_ROWS = 200      # จำนวนแถวที่ส่งไปแสดงผลบนหน้าเว็บ (ไฟล์ CSV ยังมีครบทุกแถว)
+
+
+@st.cache_data(ttl=FETCH_CACHE_TTL, show_spinner=False)
+def cached_get_all_comments(
+    video_id: str,
+    include_replies: bool,
+    order: str,
+    char_budget: int | None = None
+) -> pd.DataFrame:
+    # ไม่ใส่ API key ใน argument เพื่อไม่ให้เป็นส่วนหนึ่งของ cache key
+    # ถ้าดึงไม่สำเร็จ get_all_comments จะ raise -> st.cache_data ไม่ cache ผลนั้น กดใหม่ก็ลองใหม่ได้
+    return get_all_comments(
+        video_id,
+        YOUTUBE_API_KEY,
+        include_replies=include_replies,
+        order=order,
+        save_to_csv=False,
+        char_budget=char_budget
+    )
+
 
-def extract_single_video_id(raw_text: str) -> str | None:
+def make_preview(df: pd.DataFrame) -> pd.DataFrame:
+    """ตัวอย่างสำหรับแสดงผล: เฉพาะ PREVIEW_ROWS แถวแรกและคอลัมน์ที่ใช้จริง"""
+    cols = [c for c in PREVIEW_COLUMNS if c in df.columns]
+    head = df.head(PREVIEW_ROWS)
+    return head[cols] if cols else head
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def to_csv_bytes(_df: pd.DataFrame, video_id: str, ts: str) -> bytes:
     """
-    รองรับการกรอกทั้ง Video ID ตรง ๆ หรือ URL (watch?v=, youtu.be, shorts, embed)
-    คืนค่า video_id (ยาว 11 ตัว) หรือ None ถ้าไม่พบ
+    แปลง DataFrame เป็น CSV (utf-8-sig) ครั้งเดียวต่อการดึงข้อมูลแต่ละรอบ
+    (cache ตาม video_id + ts ไม่ต้อง hash ตัว DataFrame)
     """
-    if not raw_text:
-        return None
+    buf = io.BytesIO()
+    _df.to_csv(buf, index=False, encoding="utf-8-sig")
+    return buf.getvalue()
 
-    text = raw_text.strip()
 
-    # ถ้าเป็น video id ตรงๆ
-    if len(text) == 11 and VIDEO_ID_RE.fullmatch(text):
-        return text
+@st.cache_resource(show_spinner=False)
+def get_token_counter() -> Callable[[str], int]:
+    """
+    โหลด tokenizer ครั้งเดียว (cl100k_base ใกล้เคียงพอสำหรับประมาณจำนวน token ของ Gemini)
+    และ memoize จำนวน token ต่อข้อความ ใช้ร่วมกันทุก rerun / ทุก session
+    """
+    try:
+        enc = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:   # ครั้งแรก tiktoken ต้องดาวน์โหลดไฟล์ BPE ถ้าออฟไลน์/ถูกบล็อกจะล้ม
+        logger.warning("tiktoken unavailable, using approximate token count: %s", e)
+        enc = None
 
-    # หาใน URL รูปแบบต่าง ๆ
-    patterns = [
-        r'(?:v=)([A-Za-z0-9_-]{11})',              # ...watch?v=VIDEOID
-        r'youtu\.be/([A-Za-z0-9_-]{11})',          # youtu.be/VIDEOID
-        r'youtube\.com/embed/([A-Za-z0-9_-]{11})', # .../embed/VIDEOID
-        r'youtube\.com/shorts/([A-Za-z0-9_-]{11})' # .../shorts/VIDEOID
-    ]
-    for p in patterns:
-        m = re.search(p, text)
-        if m:
-            return m.group(1)
+    @lru_cache(maxsize=65536)
+    def count_tokens(text: str) -> int:
+        if enc is not None:
+            return len(enc.encode_ordinary(text))
+        # ประมาณแบบเผื่อไว้: ภาษาไทย/CJK ราว 1 token ต่อตัวอักษร, ภาษาอังกฤษราว 4 ตัวอักษรต่อ token
+        return len(text) if not text.isascii() else max(1, len(text) // 4)
 
-    return None
+    return count_tokens
 
 
-def build_prompt(question: str, df: pd.DataFrame, max_chars: int = 30000) -> str:
+def build_prompt(question: str, df: pd.DataFrame, max_tokens: int = PROMPT_MAX_TOKENS) -> str:
     """
     สร้างพรอมพ์ให้ Gemini:
     - ใช้คอลัมน์ 'comment' เป็นหลัก
+    - ตัดคอมเมนต์ที่ซ้ำกันออก
     - จำกัดความยาวเพื่อความเสถียร
     """
     if "comment" in df.columns:
-        comments_series = df["comment"].astype(str)
+        comments_series = df["comment"]
     else:
         # fallback: ใช้คอลัมน์อื่น ๆ ที่ดูสื่อความหมายใกล้เคียง
         candidate_cols = [c for c in df.columns if c.lower() in ("text", "content", "message")]
         if candidate_cols:
-            comments_series = df[candidate_cols[0]].astype(str)
+            comments_series = df[candidate_cols[0]]
+        elif len(df.columns):
+            # ต่อทุกคอลัมน์ทีละคอลัมน์ด้วย str.cat (vectorized) แทนการ join ทีละแถว
+            comments_series = df.iloc[:, 0].astype(str)
+            for i in range(1, len(df.columns)):
+                comments_series = comments_series.str.cat(df.iloc[:, i].astype(str), sep=" ")
         else:
-            comments_series = df.astype(str).agg(" ".join, axis=1)
+            comments_series = pd.Series([], dtype=str)
 
-    comments_text = "\n".join(comments_series.tolist())
+    # ต่อข้อความทีละคอมเมนต์จนเต็มงบ max_tokens (ไม่สร้างสตริงก้อนใหญ่แล้วค่อยตัด)
+    # และข้ามคอมเมนต์ซ้ำ (spam / bot) เทียบแบบไม่สนช่องว่างหัวท้ายและตัวพิมพ์
+    count_tokens = get_token_counter()
+    buf, n = [], 0
+    seen = set()
     truncated = False
-    if len(comments_text) > max_chars:
-        comments_text = comments_text[:max_chars]
-        truncated = True
+    for c in comments_series:
+        c = str(c)
+        key = c.strip().lower()
+        if key in seen:
+            continue
+        seen.add(key)
+        tokens = count_tokens(c) + 1   # +1 สำหรับขึ้นบรรทัดใหม่
+        if n + tokens > max_tokens:
+            truncated = True
+            break
+        buf.append(c)
+        n += tokens
+    comments_text = "\n".join(buf)
 
     prompt = f"""
 คุณคือผู้ช่วยวิเคราะห์ความเห็นของผู้ชม YouTube ในเชิงคุณภาพและปริมาณอย่างกระชับและมีโครงสร้าง
@@ -98,13 +176,43 @@ def build_prompt(question: str, df: pd.DataFrame, max_chars: int = 30000) -> str
     return prompt
 
 
-def ask_gemini(question: str, df: pd.DataFrame) -> str:
+def ask_gemini(question: str, df: pd.DataFrame, video_id: str | None = None) -> Iterator[str]:
+    """
+    ถามคำถามกับ Gemini แบบ streaming (yield ข้อความทีละช่วงเพื่อส่งให้ st.write_stream):
+    - ถ้าเคยถามคำถามที่ความหมายใกล้เคียงกันกับวิดีโอเดียวกัน ใช้คำตอบเดิมจาก cache
+    - ไม่เช่นนั้นเรียก Gemini แล้วบันทึกคำตอบลง cache เมื่อได้คำตอบครบ
+    """
+    # semantic cache เป็นแค่ตัวช่วยให้เร็วขึ้น ถ้าใช้ไม่ได้ก็ถาม Gemini ตามปกติ
+    cache = embedding = None
+    if video_id:
+        try:
+            cache = get_semantic_cache()
+            embedding = semantic_cache.embed(client, question)
+            cached = semantic_cache.lookup(cache, video_id, embedding)
+        except Exception:
+            logger.warning("semantic cache unavailable, asking Gemini directly", exc_info=True)
+            cache = None
+        else:
+            if cached:
+                yield cached
+                return
+
     prompt = build_prompt(question, df)
-    response = client.models.generate_content(
+    parts = []
+    for chunk in client.models.generate_content_stream(
         model="gemini-2.0-flash",
         contents=prompt
-    )
-    return response.text
+    ):
+        if chunk.text:
+            parts.append(chunk.text)
+            yield chunk.text
+
+    # ไม่เก็บคำตอบว่าง (เช่นถูก block) ไม่งั้นคำถามคล้ายกันจะได้คำตอบว่างไปจนหมด TTL
+    if cache is not None and parts:
+        try:
+            semantic_cache.store(cache, video_id, embedding, question, "".join(parts))
+        except Exception:
+            logger.warning("failed to store answer in semantic cache", exc_info=True)
 
 
 # -----------------------------
@@ -153,7 +261,7 @@ if video_id:
     st.caption(f"Video — `{video_id}`")
 
 # -----------------------------
-# 📥 Fetch Comments (Always fresh)
+# 📥 Fetch Comments (cache 1 ชม. ต่อวิดีโอ)
 # -----------------------------
 fetch_btn = st.button("🔄 Retrieve the Latest YouTube Comments")
 
@@ -164,12 +272,12 @@ if fetch_btn:
 
     with st.spinner("⏳ loading all comments from YouTube..."):
         try:
-            df = get_all_comments(
+            # เรียงใหม่ล่าสุดก่อน จึงดึงแค่พอสำหรับพรอมพ์ได้เลย
+            df = cached_get_all_comments(
                 video_id,
-                YOUTUBE_API_KEY,
                 include_replies=False,
                 order="time",
-                save_to_csv=False
+                char_budget=FETCH_CHAR_BUDGET
             )
 
             if df is None or df.empty:
@@ -178,6 +286,7 @@ if fetch_btn:
 
             # เก็บใน session
             st.session_state.latest_df = df
+            st.session_state.latest_preview = make_preview(df)
             st.session_state.latest_video_id = video_id
 
             # เก็บ timestamp ไว้เพื่อให้ชื่อไฟล์คงที่ข้ามการ rerun
@@ -197,12 +306,17 @@ if df is not None and not df.empty:
 
     # สรุปข้อมูลเบื้องต้น / ตัวอย่างข้อมูล
     with st.expander("🔎 All Comments"):
-        st.dataframe(df, use_container_width=True)
+        preview = st.session_state.get("latest_preview")
+        if preview is None:
+            preview = st.session_state.latest_preview = make_preview(df)
+        st.dataframe(preview, use_container_width=True)
+        if len(df) > len(preview):
+            st.caption(f"Showing the first {len(preview)} of {len(df)} comments — download the CSV for all comments")
 
     # ปุ่มดาวน์โหลด CSV (อยู่ตรงนี้เพื่อไม่หายเวลา rerun)
-    csv_bytes = df.to_csv(index=False).encode("utf-8-sig")
     ts = st.session_state.get("latest_ts") or datetime.now().strftime("%Y%m%d_%H%M%S")
     vid = st.session_state.get("latest_video_id", "unknown")
+    csv_bytes = to_csv_bytes(df, vid, ts)
     st.download_button(
         "⬇️ Download CSV",
         data=csv_bytes,
@@ -246,23 +360,27 @@ if df is not None and not df.empty:
             st.warning("please select or input your question")
             st.stop()
 
-        with st.spinner("🔍 AI Analyzing..."):
-            try:
-                answer = ask_gemini(question.strip(), df)
-                st.success("✅ Analysis completed successfullyใ")
-                st.subheader("📊 Answer from Gemini:")
-                st.write(answer)
-
-                # Save history
-                if "qa_history" not in st.session_state:
-                    st.session_state.qa_history = []
-                st.session_state.qa_history.append({
-                    "question": question.strip(),
-                    "answer": answer
-                })
-
-                # Clear selected suggestion
-                st.session_state.selected_prompt = ""
-
-            except Exception as e:
-                st.error(f"❌ An error occurred from Gemini: {e}")
+        try:
+            st.subheader("📊 Answer from Gemini:")
+            with st.spinner("🔍 AI Analyzing..."):
+                # แสดงคำตอบทีละส่วนตามที่ Gemini ส่งมา ไม่ต้องรอจนครบ
+                answer = st.write_stream(ask_gemini(
+                    question.strip(),
+                    df,
+                    video_id=st.session_state.get("latest_video_id")
+                ))
+            st.success("✅ Analysis completed successfullyใ")
+
+            # Save history
+            if "qa_history" not in st.session_state:
+                st.session_state.qa_history = []
+            st.session_state.qa_history.append({
+                "question": question.strip(),
+                "answer": answer
+            })
+
+            # Clear selected suggestion
+            st.session_state.selected_prompt = ""
+
+        except Exception as e:
+            st.error(f"❌ An error occurred from Gemini: {e}")
@@ -1,25 +1,277 @@
 # comment_fetcher.py
+import re
+import shelve
+import sqlite3
+import threading
+import orjson
 import requests
 import pandas as pd
 import time
-from typing import Optional, Callable, List, Dict, Union
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from operator import itemgetter
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Optional, Callable, List, Dict, Tuple, Union
 
 API_BASE = "https://www.googleapis.com/youtube/v3"
 
+TITLE_CACHE_PATH = ".title_cache"
+TITLE_CACHE_TTL = 7 * 24 * 3600   # 7 วัน
+TITLE_MEMO_SIZE = 256
+PAGE_CACHE_PATH = ".page_cache.sqlite"   # etag + เนื้อหาของแต่ละหน้า สำหรับ conditional request
+PAGE_CACHE_TTL = 7 * 24 * 3600           # 7 วัน
+PAGE_CACHE_MAX_BYTES = 100 * 1024 ** 2   # เกินนี้ลบหน้าที่เก่าที่สุดออก
+PAGE_PRUNE_EVERY = 100                   # ตรวจ TTL / ขนาดทุก ๆ N ครั้งที่บันทึก
+
+REPLY_WORKERS = 8
+
+# 403 ที่เป็นแค่ rate limit ชั่วคราว (ลองใหม่ได้) ต่างจาก 403 ถาวรอย่าง commentsDisabled / forbidden / quotaExceeded
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+RATE_LIMIT_RETRIES = 3
+
+_cache_lock = threading.Lock()
+_title_memo: Dict[str, Tuple[float, str]] = {}   # video_id -> (เวลาที่ดึง, ชื่อวิดีโอ)
+_page_lock = threading.Lock()
+_page_db: Optional[sqlite3.Connection] = None   # เปิดครั้งแรกที่ใช้
+_page_writes = 0
+# จำกัดจำนวน request ของ replies ที่วิ่งพร้อมกันทั้ง process (ทุก session ของ Streamlit)
+_reply_slots = threading.Semaphore(REPLY_WORKERS)
+
+
+def _make_session() -> requests.Session:
+    """
+    Session กลางของทั้งโมดูล:
+    - connection pool ใช้ซ้ำข้าม request / thread (ไม่ต้อง TLS handshake ใหม่)
+    - retry แบบ exponential backoff เมื่อเจอ 429 / 503 (403 ดูเหตุผลก่อนใน _get)
+    - ขอ response แบบ gzip (Google API ต้องมีคำว่า gzip ใน User-Agent ด้วย)
+    """
+    sess = requests.Session()
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 503],
+        allowed_methods=["GET"],
+        raise_on_status=False   # ให้ raise_for_status() แจ้ง HTTPError ตามเดิมเมื่อ retry ครบ
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+    sess.headers.update({
+        "Accept-Encoding": "gzip",
+        "User-Agent": "youtube-comment-analysis (gzip)"
+    })
+    return sess
+
+
+_SESSION = _make_session()
+
+# partial response: ขอเฉพาะ field ที่ใช้จริง (quota เท่าเดิม แต่ JSON เล็กลงมาก)
+_COMMENT_FIELDS = "authorDisplayName,authorChannelId/value,textDisplay,textOriginal,likeCount,publishedAt,updatedAt"
+THREAD_FIELDS = (
+    "nextPageToken,"
+    f"items(snippet(totalReplyCount,topLevelComment(id,snippet({_COMMENT_FIELDS}))))"
+)
+REPLY_FIELDS = f"nextPageToken,items(id,snippet(videoId,{_COMMENT_FIELDS}))"
+VIDEO_FIELDS = "items(snippet/title)"
+
+# เก็บผลแบบคอลัมน์ (dict ของ list) แทน list ของ dict ต่อแถว
+COLUMNS = (
+    "video_id", "comment_id", "parent_id", "is_reply", "video_title",
+    "author", "author_channel_id", "comment", "like_count",
+    "published_at", "updated_at", "total_reply_count",
+)
+Columns = Dict[str, List]
+
+
+def _new_columns() -> Columns:
+    return {c: [] for c in COLUMNS}
+
+
+def _extend_columns(dst: Columns, src: Columns) -> None:
+    for c in COLUMNS:
+        dst[c].extend(src[c])
+
+
+def _error_reason(resp: Optional[requests.Response]) -> Optional[str]:
+    """อ่าน reason จาก error body ของ YouTube API (เช่น quotaExceeded, commentsDisabled)"""
+    if resp is None:
+        return None
+    try:
+        return orjson.loads(resp.content)["error"]["errors"][0]["reason"]
+    except Exception:
+        return None
+
+
+def _get(url: str, params: Dict, timeout: int = 15, headers: Optional[Dict] = None) -> requests.Response:
+    """GET ผ่าน _SESSION; ถ้าได้ 403 เพราะ rate limit ลองใหม่แบบ backoff, 403 อื่น ๆ คืนทันที"""
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        resp = _SESSION.get(url, params=params, headers=headers, timeout=timeout)
+        if (
+            resp.status_code != 403
+            or attempt == RATE_LIMIT_RETRIES
+            or _error_reason(resp) not in RATE_LIMIT_REASONS
+        ):
+            return resp
+        time.sleep(0.5 * 2 ** attempt)
+    return resp
+
+
+def _prune_page_cache(conn: sqlite3.Connection) -> None:
+    """ลบหน้าที่หมดอายุ และหน้าที่เก่าที่สุดเมื่อขนาดรวมเกิน PAGE_CACHE_MAX_BYTES (เรียกขณะถือ _page_lock)"""
+    conn.execute("DELETE FROM page_cache WHERE ts < ?", (time.time() - PAGE_CACHE_TTL,))
+    conn.execute(
+        """
+        DELETE FROM page_cache WHERE key IN (
+            SELECT key FROM (
+                SELECT key, SUM(LENGTH(body)) OVER (ORDER BY ts DESC) AS total FROM page_cache
+            ) WHERE total > ?
+        )
+        """,
+        (PAGE_CACHE_MAX_BYTES,)
+    )
+    conn.commit()
+    # คืนพื้นที่ให้ไฟล์จริง ๆ (auto_vacuum = INCREMENTAL)
+    conn.execute("PRAGMA incremental_vacuum").fetchall()
+
+
+def _page_cache() -> sqlite3.Connection:
+    """เปิด (ครั้งแรก) ฐานข้อมูล page cache (เรียกขณะถือ _page_lock)"""
+    global _page_db
+    if _page_db is None:
+        conn = sqlite3.connect(PAGE_CACHE_PATH, check_same_thread=False)
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")   # มีผลตอนสร้างไฟล์ใหม่
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS page_cache (
+                key  TEXT PRIMARY KEY,
+                etag TEXT NOT NULL,
+                ts   REAL NOT NULL,
+                body BLOB NOT NULL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_page_cache_ts ON page_cache (ts)")
+        conn.commit()
+        _prune_page_cache(conn)
+        _page_db = conn
+    return _page_db
+
+
+def _get_json_conditional(url: str, params: Dict, timeout: int = 15) -> Dict:
+    """
+    GET แบบมี etag: ถ้าเคยดึง URL + params เดียวกันไว้ (ภายใน PAGE_CACHE_TTL) ส่ง If-None-Match ไปด้วย
+    ถ้าได้ 304 ใช้ข้อมูลเดิมจากดิสก์ ไม่ต้องดาวน์โหลดใหม่
+    - ก่อน request อ่านแค่ etag, เนื้อหาหน้าอ่านเฉพาะตอนได้ 304
+    """
+    global _page_writes
+    # ไม่เอา API key มาเป็นส่วนหนึ่งของ cache key
+    cache_key = url + "?" + urlencode(sorted((k, v) for k, v in params.items() if k != "key"))
+    with _page_lock:
+        row = _page_cache().execute(
+            "SELECT etag FROM page_cache WHERE key = ? AND ts >= ?",
+            (cache_key, time.time() - PAGE_CACHE_TTL)
+        ).fetchone()
+
+    headers = {"If-None-Match": row[0]} if row else None
+    resp = _get(url, params, timeout=timeout, headers=headers)
+    if resp.status_code == 304:
+        with _page_lock:
+            row = _page_cache().execute(
+                "SELECT body FROM page_cache WHERE key = ?", (cache_key,)
+            ).fetchone()
+        if row is not None:
+            return orjson.loads(row[0])
+        # ไม่มีเนื้อหาเดิมเหลืออยู่ ดึงใหม่แบบปกติ
+        resp = _get(url, params, timeout=timeout)
+    resp.raise_for_status()
+    data = orjson.loads(resp.content)
+
+    etag = resp.headers.get("ETag")
+    if etag:
+        with _page_lock:
+            conn = _page_cache()
+            conn.execute(
+                "INSERT OR REPLACE INTO page_cache (key, etag, ts, body) VALUES (?, ?, ?, ?)",
+                (cache_key, etag, time.time(), resp.content)
+            )
+            conn.commit()
+            _page_writes += 1
+            if _page_writes % PAGE_PRUNE_EVERY == 0:
+                _prune_page_cache(conn)
+    return data
+
+
+VIDEO_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+# watch?v=, youtu.be/, /embed/, /shorts/ รวมเป็น regex เดียว
+_URL_RE = re.compile(r'(?:v=|youtu\.be/|youtube\.com/(?:embed|shorts)/)([A-Za-z0-9_-]{11})')
+
+
+@lru_cache(maxsize=256)
+def extract_single_video_id(raw_text: str) -> Optional[str]:
+    """
+    รองรับการกรอกทั้ง Video ID ตรง ๆ หรือ URL (watch?v=, youtu.be, shorts, embed)
+    คืนค่า video_id (ยาว 11 ตัว) หรือ None ถ้าไม่พบ
+    """
+    if not raw_text:
+        return None
+
+    text = raw_text.strip()
+
+    # ถ้าเป็น video id ตรงๆ
+    if len(text) == 11 and VIDEO_ID_RE.fullmatch(text):
+        return text
+
+    # หาใน URL รูปแบบต่าง ๆ
+    m = _URL_RE.search(text)
+    return m.group(1) if m else None
+
+
+def _remember_title(video_id: str, entry: Tuple[float, str]) -> None:
+    """เก็บชื่อวิดีโอใน memory แบบจำกัดขนาด (ลบรายการเก่าสุดเมื่อเต็ม)"""
+    with _cache_lock:
+        _title_memo.pop(video_id, None)
+        _title_memo[video_id] = entry
+        while len(_title_memo) > TITLE_MEMO_SIZE:
+            _title_memo.pop(next(iter(_title_memo)))
+
+
+def _cached_video_title(video_id: str, api_key: str, timeout: int = 15) -> str:
+    """
+    ดึงชื่อวิดีโอ (memo ใน process + เก็บลงดิสก์) อายุ TITLE_CACHE_TTL ทั้งสองชั้น
+    error จะไม่ถูก cache
+    """
+    hit = _title_memo.get(video_id)
+    if hit is None:
+        with _cache_lock, shelve.open(TITLE_CACHE_PATH) as db:
+            hit = db.get(video_id)
+    if hit and time.time() - hit[0] < TITLE_CACHE_TTL:
+        _remember_title(video_id, hit)
+        return hit[1]
+
+    params = {"part": "snippet", "id": video_id, "key": api_key, "fields": VIDEO_FIELDS}
+    r = _get(f"{API_BASE}/videos", params, timeout=timeout)
+    r.raise_for_status()
+    items = orjson.loads(r.content).get("items", [])
+    if not items:
+        raise LookupError(video_id)
+    entry = (time.time(), items[0]["snippet"]["title"])
+
+    with _cache_lock, shelve.open(TITLE_CACHE_PATH) as db:
+        db[video_id] = entry
+    _remember_title(video_id, entry)
+    return entry[1]
+
+
 def get_video_title(
     video_id: str,
     api_key: str,
-    session: Optional[requests.Session] = None,
     timeout: int = 15
 ) -> str:
     """ดึงชื่อวิดีโอแบบปลอดภัย"""
-    sess = session or requests.Session()
-    params = {"part": "snippet", "id": video_id, "key": api_key}
     try:
-        r = sess.get(f"{API_BASE}/videos", params=params, timeout=timeout)
-        r.raise_for_status()
-        items = r.json().get("items", [])
-        return items[0]["snippet"]["title"] if items else "Unknown Title"
+        return _cached_video_title(video_id, api_key, timeout)
     except Exception:
         return "Unknown Title"
 
@@ -27,14 +279,16 @@ def get_video_title(
 def _fetch_top_level_comments(
     video_id: str,
     api_key: str,
-    session: Optional[requests.Session] = None,
     timeout: int = 15,
     order: str = "relevance",   # "time" เพื่อเรียงล่าสุดก่อน
     progress_cb: Optional[Callable[[int], None]] = None,
-    max_pages: Optional[int] = None
-) -> List[Dict]:
-    """ดึง top-level comments ทั้งหมด (แบ่งหน้า)"""
-    sess = session or requests.Session()
+    max_pages: Optional[int] = None,
+    char_budget: Optional[int] = None
+) -> Columns:
+    """
+    ดึง top-level comments ทั้งหมด (แบ่งหน้า) คืนค่าเป็นคอลัมน์ (video_title เว้นว่างไว้เติมทีหลัง)
+    - char_budget: หยุดดึงหน้าถัดไปเมื่อข้อความรวมเกิน char_budget * 1.5 (เผื่อไว้) แล้ว
+    """
     url = f"{API_BASE}/commentThreads"
     params = {
         "part": "snippet",
@@ -42,13 +296,30 @@ def _fetch_top_level_comments(
         "key": api_key,
         "maxResults": 100,
         "textFormat": "plainText",
-        "order": order
+        "order": order,
+        "fields": THREAD_FIELDS
     }
 
-    results: List[Dict] = []
+    results = _new_columns()
     page = 0
+    fetched = 0
+    total_chars = 0
     next_token: Optional[str] = None
 
+    # ผูก method ไว้เป็นตัวแปร local ลด attribute lookup ใน loop ต่อคอมเมนต์
+    get_fields = itemgetter("authorDisplayName", "likeCount", "publishedAt", "updatedAt")
+    extend_video_id = results["video_id"].extend
+    extend_parent_id = results["parent_id"].extend
+    extend_is_reply = results["is_reply"].extend
+    add_comment_id = results["comment_id"].append
+    add_author = results["author"].append
+    add_channel_id = results["author_channel_id"].append
+    add_comment = results["comment"].append
+    add_like_count = results["like_count"].append
+    add_published_at = results["published_at"].append
+    add_updated_at = results["updated_at"].append
+    add_reply_count = results["total_reply_count"].append
+
     while True:
         if max_pages is not None and page >= max_pages:
             break
@@ -58,16 +329,14 @@ def _fetch_top_level_comments(
             params.pop("pageToken", None)
 
         try:
-            resp = sess.get(url, params=params, timeout=timeout)
-            # จัดการ quota / rate limit แบบง่าย ๆ
-            if resp.status_code in (403, 429, 503):
-                # รอและลองใหม่แบบ backoff ขั้นพื้นฐาน
-                time.sleep(2)
-            resp.raise_for_status()
-            data = resp.json()
-        except Exception:
-            # หยุดลูปเมื่อเกิด error ร้ายแรง
-            break
+            # rate limit ชั่วคราวถูก retry แบบ backoff ใน _get / _SESSION แล้ว
+            data = _get_json_conditional(url, params, timeout=timeout)
+        except requests.HTTPError as e:
+            # วิดีโอปิดคอมเมนต์: เป็นผลลัพธ์ที่ถูกต้อง (ว่าง) ไม่ใช่ error ชั่วคราว
+            if page == 0 and _error_reason(e.response) == "commentsDisabled":
+                break
+            # error อื่น (quota, 5xx, network) ให้ผู้เรียกรู้ ไม่คืนผลครึ่ง ๆ กลาง ๆ
+            raise
 
         items = data.get("items", [])
         if not items:
@@ -76,27 +345,37 @@ def _fetch_top_level_comments(
             if not next_token:
                 break
 
+        # คอลัมน์ที่ค่าเหมือนกันทั้งหน้า เติมทีเดียว
+        n_items = len(items)
+        extend_video_id([video_id] * n_items)
+        extend_parent_id([None] * n_items)
+        extend_is_reply([False] * n_items)
+
         for item in items:
-            tlc = item["snippet"]["topLevelComment"]
+            outer = item["snippet"]
+            tlc = outer["topLevelComment"]
             s = tlc["snippet"]
-            results.append({
-                "video_id": video_id,
-                "comment_id": tlc.get("id"),
-                "parent_id": None,
-                "is_reply": False,
-                "video_title": "",  # จะเติมทีหลัง
-                "author": s.get("authorDisplayName"),
-                "author_channel_id": (s.get("authorChannelId") or {}).get("value"),
-                "comment": s.get("textDisplay") or s.get("textOriginal"),
-                "like_count": s.get("likeCount"),
-                "published_at": s.get("publishedAt"),
-                "updated_at": s.get("updatedAt"),
-                "total_reply_count": item["snippet"].get("totalReplyCount", 0)
-            })
+            author, likes, published, updated = get_fields(s)
+            channel = s.get("authorChannelId")
+            add_comment_id(tlc["id"])
+            add_author(author)
+            add_channel_id(channel["value"] if channel else None)
+            add_comment(s.get("textDisplay") or s.get("textOriginal"))
+            add_like_count(likes)
+            add_published_at(published)
+            add_updated_at(updated)
+            add_reply_count(outer["totalReplyCount"])
 
         page += 1
+        fetched += n_items
         if progress_cb:
-            progress_cb(len(results))
+            progress_cb(fetched)
+
+        # ข้อความพอสำหรับพรอมพ์แล้ว ไม่ต้องดึงหน้าที่เหลือ
+        if char_budget is not None and n_items:
+            total_chars += sum(len(c) + 1 for c in results["comment"][-n_items:] if c)
+            if total_chars >= char_budget * 1.5:
+                break
 
         next_token = data.get("nextPageToken")
         if not next_token:
@@ -105,62 +384,84 @@ def _fetch_top_level_comments(
     return results
 
 
-def _fetch_replies_for_parents(
-    parent_ids: List[str],
+def _fetch_replies_one_parent(
+    pid: str,
     api_key: str,
-    session: Optional[requests.Session] = None,
     timeout: int = 15
-) -> List[Dict]:
-    """ดึง replies ให้ครบทุก parent id"""
-    if not parent_ids:
-        return []
-
-    sess = session or requests.Session()
+) -> Columns:
+    """ดึง replies ทุกหน้าของ parent id เดียว"""
     url = f"{API_BASE}/comments"
     params = {
         "part": "snippet",
         "textFormat": "plainText",
         "maxResults": 100,
         "key": api_key,
+        "parentId": pid,
+        "fields": REPLY_FIELDS
     }
 
-    all_replies: List[Dict] = []
-    for pid in parent_ids:
-        params["parentId"] = pid
-        next_token: Optional[str] = None
-
-        while True:
-            if next_token:
-                params["pageToken"] = next_token
-            else:
-                params.pop("pageToken", None)
-
-            resp = sess.get(url, params=params, timeout=timeout)
-            if resp.status_code in (403, 429, 503):
-                time.sleep(2)
-            resp.raise_for_status()
-            data = resp.json()
-
-            for item in data.get("items", []):
-                s = item["snippet"]
-                all_replies.append({
-                    "video_id": s.get("videoId"),
-                    "comment_id": item.get("id"),
-                    "parent_id": pid,
-                    "is_reply": True,
-                    "video_title": "",  # จะเติมทีหลัง
-                    "author": s.get("authorDisplayName"),
-                    "author_channel_id": (s.get("authorChannelId") or {}).get("value"),
-                    "comment": s.get("textDisplay") or s.get("textOriginal"),
-                    "like_count": s.get("likeCount"),
-                    "published_at": s.get("publishedAt"),
-                    "updated_at": s.get("updatedAt"),
-                    "total_reply_count": None
-                })
+    replies = _new_columns()
+    next_token: Optional[str] = None
 
-            next_token = data.get("nextPageToken")
-            if not next_token:
-                break
+    while True:
+        if next_token:
+            params["pageToken"] = next_token
+        else:
+            params.pop("pageToken", None)
+
+        with _reply_slots:
+            resp = _get(url, params, timeout=timeout)
+        resp.raise_for_status()
+        data = orjson.loads(resp.content)
+
+        for item in data.get("items", []):
+            s = item["snippet"]
+            replies["video_id"].append(s.get("videoId"))
+            replies["comment_id"].append(item.get("id"))
+            replies["parent_id"].append(pid)
+            replies["is_reply"].append(True)
+            replies["author"].append(s.get("authorDisplayName"))
+            replies["author_channel_id"].append((s.get("authorChannelId") or {}).get("value"))
+            replies["comment"].append(s.get("textDisplay") or s.get("textOriginal"))
+            replies["like_count"].append(s.get("likeCount"))
+            replies["published_at"].append(s.get("publishedAt"))
+            replies["updated_at"].append(s.get("updatedAt"))
+            replies["total_reply_count"].append(None)
+
+        next_token = data.get("nextPageToken")
+        if not next_token:
+            break
+
+    return replies
+
+
+def _fetch_replies_for_parents(
+    parent_ids: List[str],
+    api_key: str,
+    timeout: int = 15
+) -> Columns:
+    """ดึง replies ให้ครบทุก parent id (หลาย parent พร้อมกัน) คืนค่าเป็นคอลัมน์ (video_title เว้นว่างไว้เติมทีหลัง)"""
+    all_replies = _new_columns()
+    if not parent_ids:
+        return all_replies
+
+    by_parent: Dict[str, Columns] = {}
+    with ThreadPoolExecutor(max_workers=REPLY_WORKERS) as pool:
+        futures = {
+            pool.submit(_fetch_replies_one_parent, pid, api_key, timeout): pid
+            for pid in parent_ids
+        }
+        try:
+            for fut in as_completed(futures):
+                by_parent[futures[fut]] = fut.result()
+        except BaseException:
+            # error แรกหยุดทั้งหมด: ยกเลิก parent ที่ยังไม่เริ่ม ไม่ต้องรอดึงจนครบ
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    # รวมผลตามลำดับ parent เดิม ไม่ขึ้นกับว่า thread ไหนเสร็จก่อน
+    for pid in parent_ids:
+        _extend_columns(all_replies, by_parent[pid])
 
     return all_replies
 
@@ -175,7 +476,8 @@ def get_all_comments(
     csv_path: str = "youtube_comments.csv",
     timeout: int = 15,
     progress_cb: Optional[Callable[[int], None]] = None,
-    max_pages: Optional[int] = None
+    max_pages: Optional[int] = None,
+    char_budget: Optional[int] = None
 ) -> pd.DataFrame:
     """
     ดึงคอมเมนต์จาก YouTube:
@@ -183,6 +485,8 @@ def get_all_comments(
     - include_replies=True เพื่อดึง replies ทั้งหมด
     - order="time" เพื่อเรียงคอมเมนต์ใหม่ล่าสุดก่อน
     - save_to_csv=True เพื่อบันทึกไฟล์ CSV (ค่าเริ่มต้น False)
+    - char_budget=N เพื่อหยุดดึง top-level comments เมื่อได้ข้อความพอสำหรับพรอมพ์ขนาด N ตัวอักษร
+    - ถ้าดึงหน้าใดไม่สำเร็จ (quota / 5xx / network) จะ raise แทนการคืนผลไม่ครบ
     """
     # รองรับทั้ง str และ list
     if isinstance(video_ids, str):
@@ -191,37 +495,31 @@ def get_all_comments(
     # กรอง id ที่ไม่น่าจะถูกต้อง (11 ตัวอักษร)
     video_ids = [vid.strip() for vid in video_ids if vid and len(vid.strip()) == 11]
 
-    session = requests.Session()
-    all_rows: List[Dict] = []
+    all_cols = _new_columns()
 
     for vid in video_ids:
-        title = get_video_title(vid, api_key, session=session, timeout=timeout)
+        title = get_video_title(vid, api_key, timeout=timeout)
 
         top = _fetch_top_level_comments(
             vid, api_key,
-            session=session,
             timeout=timeout,
             order=order,
             progress_cb=progress_cb,
-            max_pages=max_pages
+            max_pages=max_pages,
+            char_budget=char_budget
         )
 
         # ใส่ title ให้ทุกรายการ
-        for r in top:
-            r["video_title"] = title
-
-        rows = top
+        top["video_title"] = [title] * len(top["comment_id"])
+        _extend_columns(all_cols, top)
 
         if include_replies:
-            parent_ids = [r["comment_id"] for r in top if r.get("comment_id")]
-            reps = _fetch_replies_for_parents(parent_ids, api_key, session=session, timeout=timeout)
-            for r in reps:
-                r["video_title"] = title
-            rows.extend(reps)
-
-        all_rows.extend(rows)
+            parent_ids = [cid for cid in top["comment_id"] if cid]
+            reps = _fetch_replies_for_parents(parent_ids, api_key, timeout=timeout)
+            reps["video_title"] = [title] * len(reps["comment_id"])
+            _extend_columns(all_cols, reps)
 
-    df = pd.DataFrame(all_rows)
+    df = pd.DataFrame(all_cols, copy=False)
 
     if save_to_csv:
         df.to_csv(csv_path, index=False, encoding="utf-8-sig")
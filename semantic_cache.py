@@ -0,0 +1,107 @@
+# semantic_cache.py
+import hashlib
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import Optional, Sequence
+
+import diskcache
+import numpy as np
+import sqlite_vec
+
+DB_PATH = ".semantic_cache.sqlite"
+EMB_CACHE_PATH = ".embcache"
+EMBED_MODEL = "text-embedding-004"
+SIMILARITY_THRESHOLD = 0.86   # cosine similarity ขั้นต่ำที่ถือว่าเป็นคำถามเดียวกัน
+TTL_SECONDS = 3600            # อายุคำตอบ (1 ชม.) ให้สอดคล้องกับความสดของคอมเมนต์
+
+_lock = threading.Lock()
+# embedding ของข้อความเดิมจากโมเดลเดิมได้ค่าเดิมเสมอ เก็บลงดิสก์ไว้ใช้ข้าม restart
+_emb_disk = diskcache.Cache(EMB_CACHE_PATH)
+
+
+def connect(db_path: str = DB_PATH) -> sqlite3.Connection:
+    """เปิดฐานข้อมูล cache (sqlite + sqlite-vec) และสร้างตารางถ้ายังไม่มี"""
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.enable_load_extension(True)
+    sqlite_vec.load(conn)
+    conn.enable_load_extension(False)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS qa_cache (
+            video_id  TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            question  TEXT NOT NULL,
+            answer    TEXT NOT NULL,
+            ts        REAL NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_qa_cache_video ON qa_cache (video_id, ts)")
+    conn.commit()
+    return conn
+
+
+def normalize(values: Sequence[float]) -> np.ndarray:
+    """แปลง embedding เป็น float32 และทำ L2-normalize"""
+    vec = np.asarray(values, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+
+@lru_cache(maxsize=1024)
+def embed(client, text: str, model: str = EMBED_MODEL) -> np.ndarray:
+    """embedding (L2-normalized, float32) ของข้อความ; ใช้ cache ในหน่วยความจำ -> ดิสก์ -> Gemini"""
+    key = hashlib.blake2b(f"{model}\n{text}".encode(), digest_size=16).hexdigest()
+    raw = _emb_disk.get(key)
+    if raw is not None:
+        return np.frombuffer(raw, dtype=np.float32)
+
+    result = client.models.embed_content(model=model, contents=text)
+    vec = normalize(result.embeddings[0].values)
+    vec.setflags(write=False)   # ค่าใน lru_cache ถูกแชร์ ห้ามแก้
+    _emb_disk.set(key, vec.tobytes())
+    return vec
+
+
+def lookup(
+    conn: sqlite3.Connection,
+    video_id: str,
+    embedding: np.ndarray,
+    threshold: float = SIMILARITY_THRESHOLD,
+    ttl: int = TTL_SECONDS
+) -> Optional[str]:
+    """คืนคำตอบที่เคยถามไว้ของวิดีโอเดียวกันถ้าคำถามใกล้เคียงพอและยังไม่หมดอายุ"""
+    with _lock:
+        row = conn.execute(
+            """
+            SELECT answer, vec_distance_cosine(embedding, ?) AS dist
+            FROM qa_cache
+            WHERE video_id = ? AND ts >= ?
+            ORDER BY dist
+            LIMIT 1
+            """,
+            (embedding.tobytes(), video_id, time.time() - ttl)
+        ).fetchone()
+
+    if row is None:
+        return None
+    answer, dist = row
+    return answer if 1.0 - dist >= threshold else None
+
+
+def store(
+    conn: sqlite3.Connection,
+    video_id: str,
+    embedding: np.ndarray,
+    question: str,
+    answer: str
+) -> None:
+    """บันทึกคำถาม/คำตอบใหม่ลง cache"""
+    with _lock:
+        conn.execute(
+            "INSERT INTO qa_cache (video_id, embedding, question, answer, ts) VALUES (?, ?, ?, ?, ?)",
+            (video_id, embedding.tobytes(), question, answer, time.time())
+        )
+        conn.commit()